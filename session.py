@@ -12,18 +12,361 @@ http://opensource.org/licenses/mit-license.php
 
 Classes:
     Session -- class to provide http session with SQLite3
+    MemoryCache -- class to cache session records in memory
 """
 __author__ = 'IMAI Toshiyuki'
 __version__ = '1.0'
 
 import os
-import datetime
-import sys
-import random
-import hashlib
+import re
+import secrets
+import socket
 import sqlite3
 import pickle
 import bz2
+import time
+import threading
+import queue
+import atexit
+import logging
+import urllib.parse
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+_logger = logging.getLogger(__name__)
+
+# Format prefixes of data column.  Blobs written before the prefixes were
+# introduced are bz2 compressed pickles and begin with b'BZh'.
+_DATA_MSGPACK = b'\x01'
+_DATA_PICKLE = b'\x02'
+
+# Types which come back from MessagePack exactly as they went in.
+_MSGPACK_SCALARS = frozenset((str, float, bool, bytes, type(None)))
+# Range of integers MessagePack can express.
+_MSGPACK_INT_MIN = -2 ** 63
+_MSGPACK_INT_MAX = 2 ** 64 - 1
+
+if msgspec is not None:
+    _msgpack_encoder = msgspec.msgpack.Encoder()
+    _msgpack_decoder = msgspec.msgpack.Decoder()
+
+def _msgpack_safe(data):
+    datatype = type(data)
+    if datatype in _MSGPACK_SCALARS:
+        return True
+    if datatype is int:
+        return _MSGPACK_INT_MIN <= data <= _MSGPACK_INT_MAX
+    if datatype is list:
+        return all(_msgpack_safe(item) for item in data)
+    if datatype is dict:
+        return all(_msgpack_safe(key) and _msgpack_safe(value)
+                   for key, value in data.items())
+    return False
+
+def _encode_data(data):
+    """Serialize data for data column.
+
+    Data built from dict, list, str, 64 bit int, float, bool, bytes and
+    None is packed with MessagePack when msgspec is available.  Any other
+    data, or data MessagePack fails to encode, is pickled so that it is
+    restored with its original types.
+    """
+    if msgspec is not None:
+        try:
+            if _msgpack_safe(data):
+                return _DATA_MSGPACK + _msgpack_encoder.encode(data)
+        except (OverflowError, RecursionError, msgspec.EncodeError):
+            pass
+    return _DATA_PICKLE + pickle.dumps(data)
+
+def _decode_data(blob):
+    """Deserialize blob of data column."""
+    blob = bytes(blob)
+    prefix = blob[:1]
+    if prefix == _DATA_MSGPACK:
+        if msgspec is None:
+            raise RuntimeError('msgspec is required to load session data')
+        return _msgpack_decoder.decode(blob[1:])
+    if prefix == _DATA_PICKLE:
+        return pickle.loads(blob[1:])
+    return pickle.loads(bz2.decompress(blob))
+
+# Settings applied to each connection.  synchronous = NORMAL is durable
+# enough for sessions in WAL mode and syncs once per commit.
+_CONNECTION_PRAGMAS = ('PRAGMA synchronous = NORMAL;',
+                       'PRAGMA temp_store = MEMORY;',
+                       'PRAGMA mmap_size = 134217728;',
+                       'PRAGMA cache_size = -8000;')
+
+# SQL statements shared by all methodes, so that each of them is prepared
+# once per connection and then found in statement cache of sqlite3.
+_SQL_BEGIN = 'BEGIN IMMEDIATE;'
+_SQL_SAVEPOINT = 'SAVEPOINT write_behind;'
+_SQL_RELEASE = 'RELEASE write_behind;'
+_SQL_ROLLBACK_TO = 'ROLLBACK TO write_behind;'
+_SQL_VACUUM = 'VACUUM;'
+_SQL_JOURNAL_MODE_WAL = 'PRAGMA journal_mode = WAL;'
+_SQL_CREATE_TABLE = ('CREATE TABLE IF NOT EXISTS sessions (id PRIMARY KEY, '
+                     'data, created_time, accessed_time, '
+                     'expire_time INTEGER, remote_addr);')
+_SQL_CREATE_META_TABLE = ('CREATE TABLE IF NOT EXISTS sessions_meta '
+                          '(version INTEGER, '
+                          'last_gc INTEGER NOT NULL DEFAULT 0);')
+_SQL_SELECT_VERSION = 'SELECT version FROM sessions_meta;'
+_SQL_INSERT_VERSION = 'INSERT INTO sessions_meta (version) VALUES (?);'
+_SQL_UPDATE_VERSION = 'UPDATE sessions_meta SET version = ?;'
+_SQL_CREATE_INDEX = ('CREATE INDEX IF NOT EXISTS idx_sessions_expire '
+                     'ON sessions (expire_time);')
+_SQL_DELETE_EXPIRED = ('DELETE FROM sessions '
+                       'WHERE expire_time < ?;')
+_SQL_CLAIM_GC = 'UPDATE sessions_meta SET last_gc = ? WHERE last_gc <= ?;'
+_SQL_SELECT_RECORD = ('SELECT data, created_time, accessed_time, '
+                      'expire_time, remote_addr FROM sessions WHERE id = ?;')
+_SQL_INSERT_RECORD = ('INSERT INTO sessions (id, created_time, '
+                      'accessed_time, expire_time, remote_addr) '
+                      'VALUES (?, ?, ?, ?, ?);')
+_SQL_INSERT_RECORD_DATA = ('INSERT INTO sessions (id, data, created_time, '
+                           'accessed_time, expire_time, remote_addr) '
+                           'VALUES (?, ?, datetime(\'now\'), '
+                           'datetime(\'now\'), ?, ?);')
+# RETURNING hands back the columns of updated record not known in Python,
+# so the record needs no SELECT afterwards.
+_SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_SQL_RETURNING = ' RETURNING data, created_time;' if _SQLITE_RETURNING else ';'
+_SQL_UPDATE_RECORD = ('UPDATE sessions SET accessed_time = ?, '
+                      'expire_time = ?, remote_addr = ? '
+                      'WHERE id = ? AND expire_time >= ?' + _SQL_RETURNING)
+_SQL_UPDATE_RECORD_IPMATCH = ('UPDATE sessions SET accessed_time = ?, '
+                              'expire_time = ?, remote_addr = ? '
+                              'WHERE id = ? AND expire_time >= ? '
+                              'AND remote_addr IN (?, ?)' + _SQL_RETURNING)
+_SQL_UPDATE_DATA = 'UPDATE sessions SET data = ? WHERE id = ?;'
+_SQL_DELETE_RECORD = 'DELETE FROM sessions WHERE id = ?;'
+
+# Schema version of sessions table is kept in sessions_meta, which only
+# this module uses.  Before version 1 expire_time was stored as datetime
+# text, and before version 2 remote_addr was stored as text.
+_SQL_MIGRATE_EXPIRE_TIME = ('UPDATE sessions SET expire_time = '
+                            'CAST(strftime(\'%s\', expire_time) AS INTEGER) '
+                            'WHERE typeof(expire_time) = \'text\';')
+_SQL_SELECT_TEXT_REMOTE_ADDR = ('SELECT id, remote_addr FROM sessions '
+                                'WHERE typeof(remote_addr) = \'text\';')
+_SQL_UPDATE_REMOTE_ADDR = 'UPDATE sessions SET remote_addr = ? WHERE id = ?;'
+_SCHEMA_VERSION = 2
+
+_VALIDITY_PATTERN = re.compile(
+    r'^\s*([+-]?\d+(?:\.\d*)?)\s+(second|minute|hour|day|month|year)s?\s*$',
+    re.IGNORECASE)
+_VALIDITY_UNITS = {'second': 1,
+                   'minute': 60,
+                   'hour': 60 * 60,
+                   'day': 24 * 60 * 60,
+                   'month': 30 * 24 * 60 * 60,
+                   'year': 365 * 24 * 60 * 60}
+
+def _validity_seconds(validity):
+    """Return validity period such as '3 hours' in seconds."""
+    match = _VALIDITY_PATTERN.match(validity)
+    if match is None:
+        raise ValueError('invalid validity: {0!r}'.format(validity))
+    value, unit = match.groups()
+    return int(float(value) * _VALIDITY_UNITS[unit.lower()])
+
+def _format_time(timestamp):
+    """Return unix time as text in the format of SQLite's datetime()."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+def _pack_addr(addr):
+    """Return IPv4 or IPv6 address as 4 or 16 bytes.
+
+    Other strings, e.g. empty one, are returned as they are.
+    """
+    family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+    try:
+        return socket.inet_pton(family, addr)
+    except (OSError, ValueError):
+        return addr
+
+def _unpack_addr(addr):
+    """Return address packed by _pack_addr() as string."""
+    if isinstance(addr, bytes):
+        if len(addr) == 4:
+            return socket.inet_ntop(socket.AF_INET, addr)
+        if len(addr) == 16:
+            return socket.inet_ntop(socket.AF_INET6, addr)
+    return addr
+
+def _memory_uri(dbpath):
+    """Return URI of in-memory database for dbpath or None.
+
+    ':memory:' and 'memory://name' denote a database which lives in memory
+    and is shared by all connections of the process.  memdb VFS is used
+    where SQLite supports it, because its locks wait for busy timeout,
+    otherwise shared cache is used.
+    """
+    if not isinstance(dbpath, str):
+        return None
+    if dbpath == ':memory:':
+        name = 'sessions_mem'
+    elif dbpath.startswith('memory://'):
+        name = dbpath[len('memory://'):] or 'sessions_mem'
+    else:
+        return None
+    name = urllib.parse.quote(name, safe='')
+    if sqlite3.sqlite_version_info >= (3, 36, 0):
+        return 'file:/{0}?vfs=memdb'.format(name)
+    return 'file:{0}?mode=memory&cache=shared'.format(name)
+
+def _seconds_until(timestamp):
+    """Return seconds from now to unix time, at least 1."""
+    return max(1, timestamp - int(time.time()))
+
+class MemoryCache:
+
+    """Cache of session records in memory of the process.
+
+    Any object which provides same methodes, e.g. pymemcache.Client with
+    pickle serde, can be passed to Session as cache.
+
+    Methodes:
+        get(key) -- return value stored for key or None
+        set(key, value, expire=0) -- store value for key:
+            expire -- seconds until value expires, 0 means never
+        delete(key) -- delete value stored for key
+    """
+
+    def __init__(self, sweep_interval=60.0):
+        """Constructor of class MemoryCache.
+
+        Keyword arguments:
+
+        sweep_interval -- seconds between removals of expired values
+                          (default 60.0)
+        """
+        self._items = {}
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+
+    def get(self, key):
+        """Return value stored for key or None."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, deadline = item
+            if deadline and deadline < time.monotonic():
+                del self._items[key]
+                return None
+            return value
+
+    def set(self, key, value, expire=0):
+        """Store value for key."""
+        now = time.monotonic()
+        deadline = now + expire if expire else 0
+        with self._lock:
+            self._items[key] = (value, deadline)
+            if now - self._last_sweep >= self._sweep_interval:
+                self._sweep(now)
+
+    def _sweep(self, now):
+        # values of sessions never read again are removed here
+        self._items = {key: item for key, item in self._items.items()
+                       if not item[1] or item[1] >= now}
+        self._last_sweep = now
+
+    def delete(self, key):
+        """Delete value stored for key."""
+        with self._lock:
+            self._items.pop(key, None)
+
+class _WriteBehind:
+
+    """Background thread which applies queued writes to SQLite.
+
+    Queued statements are committed in one transaction per database.
+    Each statement runs in its own savepoint, so a failing one is logged
+    and skipped without discarding the others.  Pending writes are
+    flushed when the interpreter exits.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # number of queued writes for each (dbpath, sid)
+        self._pending = {}
+
+    def put(self, dbpath, sid, sql, parameters):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+            key = (dbpath, sid)
+            self._pending[key] = self._pending.get(key, 0) + 1
+        self._queue.put((dbpath, sid, sql, parameters))
+
+    def pending(self, dbpath, sid):
+        """Return True if writes for the session are still queued."""
+        with self._lock:
+            return (dbpath, sid) in self._pending
+
+    def flush(self):
+        self._queue.join()
+
+    def _run(self):
+        connections = {}
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            statements = {}
+            for dbpath, sid, sql, parameters in items:
+                statements.setdefault(dbpath, []).append((sql, parameters))
+            try:
+                for dbpath, queued in statements.items():
+                    if dbpath not in connections:
+                        try:
+                            connections[dbpath] = Session._connect(dbpath)
+                        except sqlite3.Error:
+                            # writes for other databases go on
+                            _logger.exception('cannot open %r', dbpath)
+                            continue
+                    self._write(connections[dbpath], queued)
+            finally:
+                with self._lock:
+                    for dbpath, sid, sql, parameters in items:
+                        key = (dbpath, sid)
+                        self._pending[key] -= 1
+                        if not self._pending[key]:
+                            del self._pending[key]
+                for _ in items:
+                    self._queue.task_done()
+
+    def _write(self, connection, statements):
+        try:
+            connection.execute(_SQL_BEGIN)
+            with connection:
+                for sql, parameters in statements:
+                    connection.execute(_SQL_SAVEPOINT)
+                    try:
+                        connection.execute(sql, parameters)
+                    except sqlite3.Error:
+                        connection.execute(_SQL_ROLLBACK_TO)
+                        _logger.exception('cannot write session: %s', sql)
+                    connection.execute(_SQL_RELEASE)
+        except sqlite3.Error:
+            # session data is not worth to stop the writer
+            _logger.exception('cannot commit session writes')
+
+_write_behind = _WriteBehind()
+atexit.register(_write_behind.flush)
 
 class Session:
 
@@ -34,6 +377,7 @@ class Session:
         dbpath -- path string for databese file of sqlite3
         validity -- validity period of session
         ipmatch -- if it is True then ip matching is checked
+        cache -- cache of session records or None
         data -- any type object
 
     Methodes:
@@ -49,6 +393,9 @@ class Session:
         save_data() -- save data on session to SQLite database
         delete() -- delete session
         vacuum() -- maintain SQLite database file
+        close() -- close connection to SQLite database
+        bulk_create(dbpath, records, validity) -- create many sessions:
+            records -- iterable of (remote_addr, data) tuples
 
     Useage:
         from http import cookies
@@ -72,7 +419,26 @@ class Session:
             ...
     """
 
-    def __init__(self, dbpath, sid=None, validity='3 hours', ipmatch=False):
+    __slots__ = ('sid', 'dbpath', 'validity', 'ipmatch', 'cache', 'data',
+                 '_conn', '_validity_seconds', '_remote_addr', '_row_cache')
+
+    # paths of databases already switched to WAL mode and migrated
+    _prepared_dbpaths = set()
+
+    # connections which keep in-memory databases alive for the process
+    _memory_keepers = {}
+    _memory_lock = threading.Lock()
+
+    # rows inserted per executemany() call of bulk_create()
+    _bulk_chunk_size = 500
+
+    # expired sessions are deleted at most once per _gc_interval seconds
+    # for each database, by whichever process comes first; until then
+    # they are skipped by id lookup
+    _gc_interval = 60
+
+    def __init__(self, dbpath, sid=None, validity='3 hours', ipmatch=False,
+                 cache=None):
 
         """Constructor of class Session.
         
@@ -82,9 +448,10 @@ class Session:
         sid -- session id (default None)
         validity -- validity period of session (default '3 hours')
         ipmatch -- if it is True then ip matching is checked (default False)
+        cache -- cache of session records such as MemoryCache (default None)
 
-        Arugument validity depends keywords of SQLite's Date and Time Functions.
-        It supposes following units of value:
+        Arugument validity is a number followed by one of following units,
+        in the manner of SQLite's Date and Time Functions:
 
             years
             months
@@ -92,52 +459,47 @@ class Session:
             hours
             minutes
             seconds
+
+        A month is taken as 30 days and a year as 365 days.
+        ValueError is raised for other forms of validity.
+
+        When cache is given, session records are read from it and data
+        saved by save_data() is written to SQLite in background.
+
+        When dbpath is ':memory:' or 'memory://name', sessions are kept in
+        an in-memory database shared within the process, without any disk
+        I/O.  They are lost when the process exits.
         """
 
         self.sid = sid
         self.dbpath = dbpath
         self.validity = validity
+        self._validity_seconds = _validity_seconds(validity)
+        self._remote_addr = _pack_addr(os.environ.get('REMOTE_ADDR', ''))
         self.ipmatch = ipmatch
+        self.cache = cache
         self.data = None
-        
+        self._conn = None
+        self._row_cache = None
+
         connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('SELECT * FROM sqlite_master \
-        WHERE type = \'table\' AND name = ?;',
-                       ('sessions',))
-        tablecount = cursor.fetchall()
-        if len(tablecount) == 0:
-            cursor.execute('CREATE TABLE sessions (id PRIMARY KEY, data, \
-            created_time, accessed_time, expire_time, remote_addr);')
-
-        cursor.execute('DELETE FROM sessions \
-        WHERE expire_time < datetime(\'now\');')
-
-        if isinstance(self.sid, str):
-            cursor.execute('SELECT id FROM sessions WHERE id = ?;',
-                           (self.sid,))
-            idcount = cursor.fetchall()
-            if len(idcount) == 0:
+        connection.execute(_SQL_BEGIN)
+        with connection:
+            connection.execute(_SQL_CREATE_TABLE)
+            connection.execute(_SQL_CREATE_INDEX)
+            now = int(time.time())
+            if connection.execute(_SQL_CLAIM_GC,
+                                  (now, now - self._gc_interval)).rowcount:
+                connection.execute(_SQL_DELETE_EXPIRED, (now,))
+
+            # no row is updated if session is unknown or expired, or
+            # with ipmatch if it was recorded for other address
+            if not (isinstance(self.sid, str) and
+                    self._update_session_record(connection)):
                 self._create_session_id()
-                self._insert_session_record(cursor)
-            else:
-                if self.ipmatch:
-                    current_addr = os.environ.get('REMOTE_ADDR', '')
-                    past_addr = self.get_remote_addr()
-                    if current_addr == past_addr:
-                        self._update_session_record(cursor)
-                    else:
-                        self._create_session_id()
-                        self._insert_session_record(cursor)
-                else:
-                    self._update_session_record(cursor)
-        else:
-            self._create_session_id()
-            self._insert_session_record(cursor)
-
-        cursor.close()
-        connection.commit()
-        connection.close()
+                self._insert_session_record(connection)
+            if self.cache is not None:
+                self._refresh_cache(connection)
 
 
     def get_id(self):
@@ -146,60 +508,28 @@ class Session:
 
     def get_created_time(self):
         """Return created time of session."""
-        connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('SELECT created_time FROM sessions WHERE id = ?;',
-                       (self.sid,))
-        created_time = cursor.fetchone()
-        cursor.close()
-        connection.close()
-        return created_time[0]
+        return self._load_record()[1]
 
     def get_accessed_time(self):
         """Return last accessed time of session."""
-        connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('SELECT accessed_time FROM sessions WHERE id = ?;',
-                       (self.sid,))
-        accessed_time = cursor.fetchone()
-        cursor.close()
-        connection.close()
-        return accessed_time[0]
+        return self._load_record()[2]
         
     def get_expire_time(self):
         """Return time that session will expire."""
-        connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('SELECT expire_time FROM sessions WHERE id = ?;',
-                       (self.sid,))
-        expire_time = cursor.fetchone()
-        cursor.close()
-        connection.close()
-        return expire_time[0]
+        return _format_time(self._load_record()[3])
 
     def get_remote_addr(self):
         """Return remote address recorded on session."""
-        connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('SELECT remote_addr FROM sessions WHERE id = ?;', \
-                       (self.sid,))
-        remote_addr = cursor.fetchone()
-        cursor.close()
-        connection.close()
-        return remote_addr[0]
+        return _unpack_addr(self._load_record()[4])
 
     def get_data(self):
         """Return data recorded on session."""
         if self.data is None:
-            connection = self._open_db()
-            cursor = connection.cursor()
-            cursor.execute('SELECT data FROM sessions WHERE id = ?;',
-                           (self.sid,))
-            data = cursor.fetchone()
+            data = self._load_record()
             if data is not None:
                 data = data[0]
             if data is not None:
-                self.data = pickle.loads(bz2.decompress(data))
+                self.data = _decode_data(data)
         return self.data
 
 
@@ -215,71 +545,190 @@ class Session:
         """Save data on session to SQLite database."""
         data = self.data
         if data is not None:
-            data = bz2.compress(pickle.dumps(data))
-            connection = self._open_db()
-            cursor = connection.cursor()
-            cursor.execute('UPDATE sessions SET data = ? WHERE id = ?;',
-                           (data, self.sid))
-            cursor.close()
-            connection.commit()
-            connection.close()
+            data = _encode_data(data)
+            if self.cache is not None:
+                record = self._load_record()
+                if record is not None:
+                    self._store_record((data,) + tuple(record[1:]))
+                _write_behind.put(self.dbpath, self.sid, _SQL_UPDATE_DATA,
+                                  (data, self.sid))
+                return
+            self._open_db().execute(_SQL_UPDATE_DATA, (data, self.sid))
+            self._row_cache = None
 
     def delete(self):
         """Delete session."""
-        connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('DELETE FROM sessions WHERE id = ?;',
-                       (self.sid,))
-        cursor.close()
-        connection.commit()
-        connection.close()
+        if self.cache is not None:
+            self.cache.delete(self.sid)
+        self._row_cache = None
+        self._open_db().execute(_SQL_DELETE_RECORD, (self.sid,))
 
     def vacuum(self):
         """Maintain SQLite database file."""
-        connection = self._open_db()
-        cursor = connection.cursor()
-        cursor.execute('vacuum;')
-        cursor.close()
-        connection.close()
+        self._open_db().execute(_SQL_VACUUM)
+
+    def close(self):
+        """Close connection to SQLite database."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+    @classmethod
+    def bulk_create(cls, dbpath, records, validity='3 hours'):
+        """Create sessions in one transaction and return their ids.
+
+        Keyword arguments:
+
+        dbpath -- path string for databese file of sqlite3
+        records -- iterable of (remote_addr, data) tuples, data may be None
+        validity -- validity period of sessions (default '3 hours')
+        """
+        expire_time = int(time.time()) + _validity_seconds(validity)
+        rows = [(secrets.token_hex(32),
+                 None if data is None else _encode_data(data),
+                 expire_time,
+                 _pack_addr(remote_addr))
+                for remote_addr, data in records]
+        connection = cls._connect(dbpath)
+        try:
+            connection.execute(_SQL_BEGIN)
+            with connection:
+                connection.execute(_SQL_CREATE_TABLE)
+                connection.execute(_SQL_CREATE_INDEX)
+                for start in range(0, len(rows), cls._bulk_chunk_size):
+                    connection.executemany(
+                        _SQL_INSERT_RECORD_DATA,
+                        rows[start:start + cls._bulk_chunk_size])
+        finally:
+            connection.close()
+        return [row[0] for row in rows]
 
 
     # internal methods
 
     def _open_db(self):
-        return sqlite3.connect(self.dbpath)
+        if self._conn is None:
+            self._conn = self._connect(self.dbpath)
+        return self._conn
+
+    @classmethod
+    def _connect(cls, dbpath):
+        uri = _memory_uri(dbpath)
+        if uri is None:
+            connection = sqlite3.connect(dbpath,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+        else:
+            with cls._memory_lock:
+                if dbpath not in cls._memory_keepers:
+                    cls._memory_keepers[dbpath] = sqlite3.connect(
+                        uri, uri=True, check_same_thread=False)
+            connection = sqlite3.connect(uri, uri=True,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+        if dbpath not in cls._prepared_dbpaths:
+            # journal mode is persistent in database file
+            connection.execute(_SQL_JOURNAL_MODE_WAL)
+            cls._migrate(connection)
+            cls._prepared_dbpaths.add(dbpath)
+        for pragma in _CONNECTION_PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    @staticmethod
+    def _migrate(connection):
+        connection.execute(_SQL_BEGIN)
+        with connection:
+            connection.execute(_SQL_CREATE_TABLE)
+            connection.execute(_SQL_CREATE_META_TABLE)
+            row = connection.execute(_SQL_SELECT_VERSION).fetchone()
+            if row is None:
+                # sessions table of any age before sessions_meta existed
+                version = 0
+                connection.execute(_SQL_INSERT_VERSION, (version,))
+            else:
+                version = row[0]
+            if version < _SCHEMA_VERSION:
+                if version < 1:
+                    connection.execute(_SQL_MIGRATE_EXPIRE_TIME)
+                if version < 2:
+                    rows = connection.execute(_SQL_SELECT_TEXT_REMOTE_ADDR)
+                    connection.executemany(
+                        _SQL_UPDATE_REMOTE_ADDR,
+                        [(_pack_addr(addr), sid) for sid, addr in rows])
+                connection.execute(_SQL_UPDATE_VERSION, (_SCHEMA_VERSION,))
+
+    def _load_record(self):
+        # whole record is read at once and kept until it is changed
+        if self._row_cache is None:
+            record = None
+            if self.cache is not None:
+                record = self.cache.get(self.sid)
+            if record is None:
+                record = self._open_db().execute(_SQL_SELECT_RECORD,
+                                                 (self.sid,)).fetchone()
+                if record is not None and self.cache is not None:
+                    self._store_record(record)
+            self._row_cache = record
+        return self._row_cache
+
+    def _store_record(self, record):
+        self._row_cache = record
+        self.cache.set(self.sid, record, _seconds_until(record[3]))
+
+    def _refresh_cache(self, connection):
+        record = self._row_cache
+        if record is None:
+            # SQLite without RETURNING
+            record = connection.execute(_SQL_SELECT_RECORD,
+                                        (self.sid,)).fetchone()
+        if _write_behind.pending(self.dbpath, self.sid):
+            # data saved by this process is not in SQLite yet; otherwise
+            # SQLite wins, it may hold data saved by other processes
+            cached = self.cache.get(self.sid)
+            if cached is not None:
+                record = (cached[0],) + record[1:]
+        self._store_record(record)
 
     def _create_session_id(self):
-        connection = self._open_db()
-        cursor = connection.cursor()
-        while True:
-            now = datetime.datetime.today()
-            seed = '{0}{1}{2}'.format(str(os.getpid()),
-                                      str(now.isoformat()),
-                                      str(random.randint(0, sys.maxsize - 1)))
-            message = hashlib.new('sha256')
-            message.update(seed.encode('utf-8'))
-            sid = message.hexdigest()
-            cursor.execute('SELECT id FROM sessions WHERE id = ?;',
-                           (sid,))
-            idcount = cursor.fetchall()
-            if len(idcount) == 0:
-                self.sid = sid
-                break
-        cursor.close()
-        connection.close()
-
-    def _insert_session_record(self, cursor):
-        cursor.execute('INSERT INTO sessions (id, created_time, \
-        accessed_time, expire_time, remote_addr) VALUES(?, datetime(\'now\'), \
-        datetime(\'now\'), datetime(\'now\', ?), ?);',
-                       (self.sid,
-                        self.validity,
-                        os.environ.get('REMOTE_ADDR', '')))
-
-    def _update_session_record(self, cursor):
-        cursor.execute('UPDATE sessions SET accessed_time = datetime(\'now\'), \
-        expire_time = datetime(\'now\', ?), remote_addr = ? \
-        where id = ?;', \
-                       (self.validity,
-                        os.environ.get('REMOTE_ADDR', ''),
-                        self.sid))
+        # 256 bits from the OS CSPRNG never collide in practice; if they
+        # did, INSERT would fail on the primary key rather than reuse it.
+        self.sid = secrets.token_hex(32)
+
+    def _insert_session_record(self, connection):
+        now = int(time.time())
+        now_text = _format_time(now)
+        expire_time = now + self._validity_seconds
+        connection.execute(_SQL_INSERT_RECORD,
+                           (self.sid, now_text, now_text, expire_time,
+                            self._remote_addr))
+        self._row_cache = (None, now_text, now_text, expire_time,
+                           self._remote_addr)
+
+    def _update_session_record(self, connection):
+        # return True if session record was updated, and keep the record
+        # if SQLite returns its remaining columns
+        now = int(time.time())
+        now_text = _format_time(now)
+        expire_time = now + self._validity_seconds
+        if self.ipmatch:
+            # address may still be text if it was written before schema
+            # version 2, e.g. by a process not yet upgraded
+            cursor = connection.execute(_SQL_UPDATE_RECORD_IPMATCH,
+                                        (now_text, expire_time,
+                                         self._remote_addr, self.sid, now,
+                                         self._remote_addr,
+                                         _unpack_addr(self._remote_addr)))
+        else:
+            cursor = connection.execute(_SQL_UPDATE_RECORD,
+                                        (now_text, expire_time,
+                                         self._remote_addr, self.sid, now))
+        if not _SQLITE_RETURNING:
+            return cursor.rowcount > 0
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        self._row_cache = (row[0], row[1], now_text, expire_time,
+                           self._remote_addr)
+        return True